@@ -1,15 +1,23 @@
 import numpy as np
 import io
-import httpx
 import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import librosa
+import soundfile as sf
+from scipy.fft import rfft, rfftfreq
 import tempfile
 from fastapi import File, UploadFile
+from http_client import get_client
 
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
+# scipy.fft releases the GIL, so per-segment FFTs run in parallel on threads
+# without pickling each segment over to a worker process.
+fft_pool = ThreadPoolExecutor(max_workers=max(1, (os.cpu_count() or 2) // 2))
+
 def estimate_speaker_direction(audio_data, sample_rate):
     """
     Estimate speaker direction using phase difference analysis.
@@ -22,13 +30,15 @@ def estimate_speaker_direction(audio_data, sample_rate):
     
     # Use frequency domain analysis to estimate direction
     # Higher frequencies tend to come from different directions
-    fft = np.fft.fft(audio_data)
-    freqs = np.fft.fftfreq(len(audio_data), 1/sample_rate)
+    # Real input, so only the non-negative half of the spectrum is computed
+    spectrum = np.abs(rfft(audio_data))
+    freqs = rfftfreq(len(audio_data), 1/sample_rate)
     
-    # Analyze power in different frequency bands
-    low_freq_power = np.sum(np.abs(fft[(freqs > 0) & (freqs < 1000)]))
-    mid_freq_power = np.sum(np.abs(fft[(freqs >= 1000) & (freqs < 4000)]))
-    high_freq_power = np.sum(np.abs(fft[(freqs >= 4000) & (freqs < 8000)]))
+    # Analyze power in different frequency bands (bin 0 is DC and skipped)
+    i1000, i4000, i8000 = np.searchsorted(freqs, [1000, 4000, 8000])
+    low_freq_power = np.sum(spectrum[1:i1000])
+    mid_freq_power = np.sum(spectrum[i1000:i4000])
+    high_freq_power = np.sum(spectrum[i4000:i8000])
     
     # Simple heuristic: more high frequencies might indicate closer/front
     # This is a placeholder - real implementation needs mic array
@@ -62,13 +72,10 @@ def separate_speakers_simple(audio_data, sample_rate):
     frame_length = int(sample_rate * 0.025)  # 25ms frames
     hop_length = int(sample_rate * 0.010)    # 10ms hop
     
-    # Calculate energy per frame
-    energy = []
-    for i in range(0, len(audio_data) - frame_length, hop_length):
-        frame = audio_data[i:i+frame_length]
-        energy.append(np.sum(frame ** 2))
-    
-    energy = np.array(energy)
+    # Calculate energy per frame as one reduction over strided windows
+    n_frames = len(range(0, len(audio_data) - frame_length, hop_length))
+    frames = np.lib.stride_tricks.sliding_window_view(audio_data, frame_length)[::hop_length][:n_frames]
+    energy = np.einsum('ij,ij->i', frames, frames)
     
     # Simple voice activity detection
     threshold = np.percentile(energy, 30)
@@ -120,37 +127,36 @@ async def transcribe_audio_segment(audio_bytes, sample_rate):
     }
     
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(url, json=json_data)
-            if response.status_code == 200:
-                data = response.json()
-                return data.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "")
+        response = await get_client().post(url, json=json_data, timeout=30.0)
+        if response.status_code == 200:
+            data = response.json()
+            return data.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "")
     except Exception as e:
         print(f"Transcription error: {e}")
     
     return ""
 
+_LABEL_PROMPT_PREFIX = (
+    "You are helping label speakers in a room for a blind person. "
+    "Based on the detected speakers and their characteristics, provide spatial labels.\n\n"
+    "Detected speakers:\n"
+)
+_LABEL_PROMPT_SUFFIX = (
+    "\n\nProvide labels like 'Man on your left', 'Teacher at the front', "
+    "'Student near door', etc. Return JSON array with 'label' field for each speaker."
+)
+
 async def label_spatial_position(speakers_data):
     """Use Gemini to intelligently label speaker positions"""
     if not GEMINI_API_KEY:
         return speakers_data
     
-    prompt = (
-        "You are helping label speakers in a room for a blind person. "
-        "Based on the detected speakers and their characteristics, provide spatial labels.\n\n"
-        "Detected speakers:\n"
-    )
-    
-    for i, speaker in enumerate(speakers_data):
-        prompt += (
-            f"Speaker {i+1}: direction={speaker.get('direction', 'unknown')}, "
-            f"duration={speaker.get('duration', 0):.1f}s\n"
-        )
-    
-    prompt += (
-        "\nProvide labels like 'Man on your left', 'Teacher at the front', "
-        "'Student near door', etc. Return JSON array with 'label' field for each speaker."
+    lines = "\n".join(
+        f"Speaker {i+1}: direction={speaker.get('direction', 'unknown')}, "
+        f"duration={speaker.get('duration', 0):.1f}s"
+        for i, speaker in enumerate(speakers_data)
     )
+    prompt = _LABEL_PROMPT_PREFIX + lines + _LABEL_PROMPT_SUFFIX
     
     url = (
         f"https://generativelanguage.googleapis.com/v1beta/models/"
@@ -162,26 +168,49 @@ async def label_spatial_position(speakers_data):
     }
     
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(url, json=json_data)
-            if response.status_code == 200:
-                data = response.json()
-                result_text = data.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "")
-                
-                # Try to parse JSON from response
-                import json
-                import re
-                json_match = re.search(r'\[.*\]', result_text, re.DOTALL)
-                if json_match:
-                    labels = json.loads(json_match.group())
-                    for i, label_data in enumerate(labels):
-                        if i < len(speakers_data):
-                            speakers_data[i]['spatial_label'] = label_data.get('label', f'Speaker {i+1}')
+        response = await get_client().post(url, json=json_data, timeout=30.0)
+        if response.status_code == 200:
+            data = response.json()
+            result_text = data.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "")
+            
+            # Try to parse JSON from response
+            import json
+            import re
+            json_match = re.search(r'\[.*\]', result_text, re.DOTALL)
+            if json_match:
+                labels = json.loads(json_match.group())
+                for i, label_data in enumerate(labels):
+                    if i < len(speakers_data):
+                        speakers_data[i]['spatial_label'] = label_data.get('label', f'Speaker {i+1}')
     except Exception as e:
         print(f"Labeling error: {e}")
     
     return speakers_data
 
+def load_audio(audio_bytes, sr):
+    """
+    Decode uploaded audio at sample rate sr, shaped like librosa.load(mono=False).
+    WAV/FLAC/OGG are decoded straight from memory; anything libsndfile can't
+    read (e.g. the AAC/m4a the mobile recorder produces) goes through a temp
+    file so librosa can fall back to audioread.
+    """
+    try:
+        audio_data, sample_rate = sf.read(io.BytesIO(audio_bytes), dtype='float32', always_2d=False)
+    except RuntimeError:
+        with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as tmp_file:
+            tmp_file.write(audio_bytes)
+            tmp_path = tmp_file.name
+        try:
+            return librosa.load(tmp_path, sr=sr, mono=False)
+        finally:
+            os.unlink(tmp_path)
+    
+    # soundfile is (frames, channels); librosa is (channels, frames)
+    audio_data = audio_data.T
+    if sample_rate != sr:
+        audio_data = librosa.resample(audio_data, orig_sr=sample_rate, target_sr=sr, res_type='soxr_hq')
+    return audio_data, sr
+
 async def process_audio(file: UploadFile = File(...)):
     """
     Process audio file to separate speakers and provide spatial captions.
@@ -190,81 +219,75 @@ async def process_audio(file: UploadFile = File(...)):
         # Read audio file
         audio_bytes = await file.read()
         
-        # Save to temporary file for librosa
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as tmp_file:
-            tmp_file.write(audio_bytes)
-            tmp_path = tmp_file.name
+        # Load audio
+        audio_data, sample_rate = load_audio(audio_bytes, sr=16000)
         
-        try:
-            # Load audio
-            audio_data, sample_rate = librosa.load(tmp_path, sr=16000, mono=False)
+        # If stereo, use both channels for direction estimation
+        if len(audio_data.shape) > 1:
+            # Estimate direction from stereo channels
+            left_channel = audio_data[0] if audio_data.shape[0] > 0 else audio_data
+            right_channel = audio_data[1] if audio_data.shape[0] > 1 else audio_data
+            
+            # Simple phase difference for direction
+            correlation = np.corrcoef(left_channel[:min(len(left_channel), len(right_channel))], 
+                                     right_channel[:min(len(left_channel), len(right_channel))])[0, 1]
             
-            # If stereo, use both channels for direction estimation
-            if len(audio_data.shape) > 1:
-                # Estimate direction from stereo channels
-                left_channel = audio_data[0] if audio_data.shape[0] > 0 else audio_data
-                right_channel = audio_data[1] if audio_data.shape[0] > 1 else audio_data
-                
-                # Simple phase difference for direction
-                correlation = np.corrcoef(left_channel[:min(len(left_channel), len(right_channel))], 
-                                         right_channel[:min(len(left_channel), len(right_channel))])[0, 1]
-                
-                if correlation > 0.8:
-                    direction = "center"
-                elif np.mean(left_channel) > np.mean(right_channel) * 1.2:
-                    direction = "left"
-                elif np.mean(right_channel) > np.mean(left_channel) * 1.2:
-                    direction = "right"
-                else:
-                    direction = "center"
-                
-                audio_data = np.mean(audio_data, axis=0)  # Convert to mono for processing
+            if correlation > 0.8:
+                direction = "center"
+            elif np.mean(left_channel) > np.mean(right_channel) * 1.2:
+                direction = "left"
+            elif np.mean(right_channel) > np.mean(left_channel) * 1.2:
+                direction = "right"
             else:
-                direction = estimate_speaker_direction(audio_data, sample_rate)
+                direction = "center"
             
-            # Separate speakers (simplified)
-            segments = separate_speakers_simple(audio_data, sample_rate)
+            audio_data = np.mean(audio_data, axis=0)  # Convert to mono for processing
+        else:
+            direction = estimate_speaker_direction(audio_data, sample_rate)
+        
+        # Separate speakers (simplified)
+        segments = separate_speakers_simple(audio_data, sample_rate)
+        segments = segments[:5]  # Limit to 5 speakers
+        
+        # Estimate direction for every segment concurrently
+        loop = asyncio.get_running_loop()
+        seg_directions = await asyncio.gather(*(
+            loop.run_in_executor(fft_pool, estimate_speaker_direction, audio_data[start:end], sample_rate)
+            for start, end in segments
+        ))
+        
+        # Process each segment
+        speakers = []
+        for i, ((start, end), seg_direction) in enumerate(zip(segments, seg_directions)):
+            segment_audio = audio_data[start:end]
             
-            # Process each segment
-            speakers = []
-            for i, (start, end) in enumerate(segments[:5]):  # Limit to 5 speakers
-                segment_audio = audio_data[start:end]
-                
-                # Estimate direction for this segment
-                seg_direction = estimate_speaker_direction(segment_audio, sample_rate)
-                
-                # Convert segment back to bytes for transcription
-                segment_bytes = (segment_audio * 32767).astype(np.int16).tobytes()
-                
-                # Transcribe (placeholder - implement actual transcription)
-                # For now, we'll skip transcription and use Gemini for labeling
-                text = ""  # await transcribe_audio_segment(segment_bytes, sample_rate)
-                
-                duration = (end - start) / sample_rate
-                
-                speakers.append({
-                    "id": i,
-                    "direction": seg_direction or direction,
-                    "duration": duration,
-                    "text": text,
-                    "start_time": start / sample_rate,
-                    "end_time": end / sample_rate
-                })
+            # Convert segment back to bytes for transcription
+            segment_bytes = (segment_audio * 32767).astype(np.int16).tobytes()
             
-            # Use Gemini to label spatial positions
-            speakers = await label_spatial_position(speakers)
+            # Transcribe (placeholder - implement actual transcription)
+            # For now, we'll skip transcription and use Gemini for labeling
+            text = ""  # await transcribe_audio_segment(segment_bytes, sample_rate)
             
-            return {
-                "speakers": speakers,
-                "total_duration": len(audio_data) / sample_rate,
-                "sample_rate": sample_rate
-            }
+            duration = (end - start) / sample_rate
             
-        finally:
-            # Clean up temp file
-            if os.path.exists(tmp_path):
-                os.unlink(tmp_path)
-                
+            speakers.append({
+                "id": i,
+                "direction": seg_direction or direction,
+                "duration": duration,
+                "text": text,
+                "start_time": start / sample_rate,
+                "end_time": end / sample_rate
+            })
+        
+        # Use Gemini to label spatial positions
+        speakers = await label_spatial_position(speakers)
+        
+        return {
+            "speakers": speakers,
+            "total_duration": len(audio_data) / sample_rate,
+            "sample_rate": sample_rate
+        }
+        
     except Exception as e:
         print(f"Audio processing error: {e}")
         import traceback
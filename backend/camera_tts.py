@@ -4,16 +4,25 @@ import numpy as np
 import cv2
 import io
 import asyncio
-import httpx
+import hashlib
+import importlib.util
 import os
+import time
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import LRUCache
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+from gemini_cache import alert_cache, fingerprint
+from http_client import get_client, close_client
+from yolo_engine import YOLO_IMGSZ, YOLO_MAX_BATCH, engine_path
 
 load_dotenv()  # loads .env file into environment variables
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # Add CORS middleware
 app.add_middleware(
@@ -24,39 +33,202 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-yolo_model = YOLO("yolov8n.pt")
+# FP16 halves the bytes moved per layer on CUDA; CPU inference stays FP32.
+YOLO_HALF = torch.cuda.is_available()
 
-def get_direction(bbox, width):
-    x1, _, x2, _ = bbox
-    mid = (x1 + x2) / 2
-    if mid < width * 0.33:
-        return "left"
-    elif mid > width * 0.66:
-        return "right"
-    return "center"
+# Concurrent /detect/ frames are coalesced into one forward pass: the batcher
+# waits a few ms after the first frame arrives and runs up to YOLO_MAX_BATCH.
+YOLO_BATCH_WINDOW = 0.005
 
-def estimate_distance_from_bbox(bbox, frame_height):
-    x1, y1, x2, y2 = bbox
-    box_height = y2 - y1
+def load_yolo(weights):
+    """Load YOLO, preferring a pre-built TensorRT engine on CUDA hosts.
+
+    The engine is built ahead of time with yolo_engine.py; the server never
+    exports or installs anything itself. Falls back to the PyTorch weights
+    if there is no engine for the current YOLO_IMGSZ/YOLO_MAX_BATCH, if
+    tensorrt isn't installed, or if the engine doesn't run on this host.
+    """
+    path = engine_path(weights)
+    if (not torch.cuda.is_available() or not os.path.exists(path)
+            or importlib.util.find_spec("tensorrt") is None):
+        return YOLO(weights)
+    try:
+        engine = YOLO(path, task="detect")
+        # Engines are only deserialized on first predict; run a full batch now
+        # so an engine built for another GPU or TensorRT version, or one that
+        # can't take the batcher's largest batch, fails here instead of on
+        # every request.
+        dummy = [np.zeros((YOLO_IMGSZ, YOLO_IMGSZ, 3), np.uint8)] * YOLO_MAX_BATCH
+        engine(dummy, verbose=False, imgsz=YOLO_IMGSZ, half=YOLO_HALF)
+    except Exception as e:
+        print(f"TensorRT engine unusable, using PyTorch weights: {e}")
+        return YOLO(weights)
+    return engine
+
+yolo_model = load_yolo("yolov8n.pt")
+
+# JPEG decode and YOLO run off the event loop so one request's inference can
+# overlap the next upload's decode and other requests' Gemini round-trips.
+# YOLO gets a single worker so the model is only ever driven by one thread.
+cv_pool = ThreadPoolExecutor(max_workers=2)
+yolo_pool = ThreadPoolExecutor(max_workers=1)
+
+# Detections keyed by a hash of the uploaded JPEG bytes, so a frame that is
+# sent again skips decode and inference entirely.
+_yolo_cache = LRUCache(maxsize=64)
+
+def run_yolo(frames):
+    return yolo_model(frames, verbose=False, imgsz=YOLO_IMGSZ, half=YOLO_HALF)
+
+# Frames waiting for the batcher, as (frame, future) pairs, and the batcher
+# task draining them. Both are created by the first infer() call so they
+# belong to the event loop actually serving requests, whether or not the
+# app's lifespan hooks ran.
+_yolo_queue = None
+_yolo_batcher_task = None
+
+async def yolo_batcher(queue):
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        await asyncio.sleep(YOLO_BATCH_WINDOW)
+        while len(batch) < YOLO_MAX_BATCH and not queue.empty():
+            batch.append(queue.get_nowait())
+
+        try:
+            results = await loop.run_in_executor(yolo_pool, run_yolo, [frame for frame, _ in batch])
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            continue
+        for (_, fut), result in zip(batch, results):
+            if not fut.done():
+                fut.set_result(result)
+
+async def infer(frame):
+    global _yolo_queue, _yolo_batcher_task
+    loop = asyncio.get_running_loop()
+    if (_yolo_batcher_task is None or _yolo_batcher_task.done()
+            or _yolo_batcher_task.get_loop() is not loop):
+        _yolo_queue = asyncio.Queue()
+        _yolo_batcher_task = loop.create_task(yolo_batcher(_yolo_queue))
+
+    fut = loop.create_future()
+    await _yolo_queue.put((frame, fut))
+    return await fut
+
+def get_direction(xyxy, width):
+    mid = (xyxy[:, 0] + xyxy[:, 2]) / 2
+    return np.select([mid < width * 0.33, mid > width * 0.66], ["left", "right"], "center")
+
+def estimate_distance_from_bbox(xyxy, frame_height):
+    box_height = xyxy[:, 3] - xyxy[:, 1]
     relative_height = box_height / frame_height
-    distance = max(0.2, 3 * (1 - relative_height))
-    return round(distance, 2)
+    distance = np.maximum(0.2, 3 * (1 - relative_height))
+    # Python's round(), not np.round: the two disagree on values like x.xx5,
+    # which would shift distances (and risk bands) from what clients got before
+    return np.array([round(d, 2) for d in distance.tolist()], dtype=np.float64)
 
-async def query_gemini(detected_objects):
-    prompt = (
-        "You are assisting a blind person by describing objects from their camera. "
-        "List objects with distances, risk levels, and directions. Provide a short warning."
-        "\n\nDetected objects:\n"
+def get_risk(distance):
+    return np.select([distance < 0.7, distance < 1.5], ["danger", "caution"], "clear")
+
+class DetBatch:
+    """Detections for one frame as parallel arrays, one row per box.
+
+    Kept columnar through prompt building and caching; converted to a list
+    of dicts only when the response is returned.
+    """
+
+    __slots__ = ("labels", "confidence", "distance", "direction", "risk", "bbox")
+
+    def __init__(self, labels, confidence, distance, direction, risk, bbox):
+        self.labels = labels
+        self.confidence = confidence
+        self.distance = distance
+        self.direction = direction
+        self.risk = risk
+        self.bbox = bbox
+
+    def __len__(self):
+        return len(self.labels)
+
+    def to_dicts(self):
+        return [
+            {
+                "label": l,
+                "confidence": cf,
+                "distance": d,
+                "direction": dr,
+                "risk": r,
+                "bbox": tuple(b)
+            }
+            for l, cf, d, dr, r, b in zip(
+                self.labels, self.confidence.tolist(), self.distance.tolist(),
+                self.direction.tolist(), self.risk.tolist(), self.bbox.tolist()
+            )
+        ]
+
+def build_detections(results, frame_height, frame_width):
+    # Pull every box off the device once instead of once per detection
+    boxes = results.boxes
+    xyxy = boxes.xyxy.cpu().numpy().astype(np.int32)
+    cls = boxes.cls.cpu().numpy().astype(np.int32)
+    conf = boxes.conf.cpu().numpy()
+
+    distance = estimate_distance_from_bbox(xyxy, frame_height)
+    return DetBatch(
+        labels=[yolo_model.names[c] for c in cls.tolist()],
+        confidence=conf,
+        distance=distance,
+        direction=get_direction(xyxy, frame_width),
+        risk=get_risk(distance),
+        bbox=xyxy,
     )
-    for obj in detected_objects:
-        prompt += (
-            f"- {obj['label']} at {obj['distance']}m, "
-            f"risk: {obj['risk']}, direction: {obj['direction']}\n"
-        )
-    prompt += "\nRespond in 1–2 short sentences, with urgent risks first."
-    
+
+_PROMPT_PREFIX = (
+    "You are assisting a blind person by describing objects from their camera. "
+    "List objects with distances, risk levels, and directions. Provide a short warning."
+    "\n\nDetected objects:\n"
+)
+_PROMPT_SUFFIX = "\n\nRespond in 1–2 short sentences, with urgent risks first."
+
+# The last scene that got an alert, that alert, and when it was produced.
+# While the sorted (label, direction, risk) rows stay the same, the alert is
+# reused as is, but no longer than an alert_cache entry would live.
+_last_scene = None
+_last_alert_text = None
+_last_alert_at = 0.0
+
+async def query_gemini(detected_objects):
+    global _last_scene, _last_alert_text, _last_alert_at
+
     if not GEMINI_API_KEY:
         return "API key not configured. Please set GEMINI_API_KEY in your .env file."
+
+    scene = tuple(sorted(zip(
+        detected_objects.labels, detected_objects.direction.tolist(), detected_objects.risk.tolist()
+    )))
+    if scene == _last_scene and time.monotonic() - _last_alert_at < alert_cache.ttl:
+        return _last_alert_text
+
+    key = fingerprint(detected_objects)
+    cached = alert_cache.get(key)
+    if cached is not None:
+        # Keep the alert's original production time so the shortcut above
+        # can't extend its life past the cache's TTL
+        alert_text, produced_at = cached
+        _last_scene, _last_alert_text, _last_alert_at = scene, alert_text, produced_at
+        return alert_text
+
+    lines = "\n".join(
+        f"- {label} at {distance}m, risk: {risk}, direction: {direction}"
+        for label, distance, risk, direction in zip(
+            detected_objects.labels, detected_objects.distance.tolist(),
+            detected_objects.risk.tolist(), detected_objects.direction.tolist()
+        )
+    )
+    prompt = _PROMPT_PREFIX + lines + _PROMPT_SUFFIX
     
     url = (
         f"https://generativelanguage.googleapis.com/v1beta/models/"
@@ -65,60 +237,52 @@ async def query_gemini(detected_objects):
     json_data = {
         "contents": [
             {"parts": [{"text": prompt}]}
-        ]
+        ],
+        "generationConfig": {"temperature": 0}
     }
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, json=json_data)
-        if response.status_code != 200:
-            error_detail = response.text
-            print(f"Gemini API error: {response.status_code} - {error_detail}")
-            # Return a fallback message instead of crashing
-            return f"Warning: {len(detected_objects)} object(s) detected nearby. Please proceed with caution."
-        data = response.json()
-        return data["candidates"][0]["content"]["parts"][0]["text"]
+    response = await get_client().post(url, json=json_data)
+    if response.status_code != 200:
+        error_detail = response.text
+        print(f"Gemini API error: {response.status_code} - {error_detail}")
+        # Return a fallback message instead of crashing
+        return f"Warning: {len(detected_objects)} object(s) detected nearby. Please proceed with caution."
+    data = response.json()
+    alert_text = data["candidates"][0]["content"]["parts"][0]["text"]
+    produced_at = time.monotonic()
+    alert_cache[key] = (alert_text, produced_at)
+    _last_scene, _last_alert_text, _last_alert_at = scene, alert_text, produced_at
+    return alert_text
+
+@app.on_event("shutdown")
+async def stop_yolo_batcher():
+    if _yolo_batcher_task is not None:
+        _yolo_batcher_task.cancel()
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await close_client()
 
 @app.post("/detect/")
 async def detect(file: UploadFile = File(...)):
     # Read image bytes
     contents = await file.read()
-    np_arr = np.frombuffer(contents, np.uint8)
-    frame = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-    h, w, _ = frame.shape
-
-    results = yolo_model(frame, verbose=False)[0]
-    objects = []
-    for box in results.boxes:
-        cls = int(box.cls[0])
-        label = yolo_model.names[cls]
-        conf = float(box.conf[0])
-
-        x1, y1, x2, y2 = box.xyxy[0].cpu().numpy()
-        x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
-
-        distance = estimate_distance_from_bbox((x1, y1, x2, y2), h)
-        direction = get_direction((x1, y1, x2, y2), w)
-
-        if distance < 0.7:
-            risk = "danger"
-        elif distance < 1.5:
-            risk = "caution"
-        else:
-            risk = "clear"
-
-        objects.append({
-            "label": label,
-            "confidence": conf,
-            "distance": distance,
-            "direction": direction,
-            "risk": risk,
-            "bbox": (x1, y1, x2, y2)
-        })
+    image_key = hashlib.blake2b(contents, digest_size=16).digest()
+    objects = _yolo_cache.get(image_key)
+    if objects is None:
+        np_arr = np.frombuffer(contents, np.uint8)
+        loop = asyncio.get_running_loop()
+        frame = await loop.run_in_executor(cv_pool, cv2.imdecode, np_arr, cv2.IMREAD_COLOR)
+        h, w, _ = frame.shape
+
+        results = await infer(frame)
+        objects = build_detections(results, h, w)
+        _yolo_cache[image_key] = objects
 
     # Query Gemini for a summary
     alert_text = await query_gemini(objects)
 
     return {
-        "objects": objects,
+        "objects": objects.to_dicts(),
         "alert_text": alert_text
     }
 
@@ -0,0 +1,22 @@
+import hashlib
+import json
+from cachetools import TTLCache
+
+# Gemini alerts keyed by scene fingerprint, stored as (alert_text, produced_at)
+# with produced_at from time.monotonic(). Distances are binned in the key
+# but sent exactly in the prompt, so this deliberately reuses an answer for a
+# nearly identical scene (say, a chair that moved from 1.3m to 1.4m) rather
+# than paying for another round-trip. Entries expire after 30s, which bounds
+# how stale a reused alert can get. Requests use temperature 0 to keep
+# answers for the same scene consistent, though that does not make them exact.
+alert_cache = TTLCache(maxsize=512, ttl=30)
+
+def fingerprint(detections):
+    """Order-independent key for a DetBatch, with distances binned to 0.5m."""
+    items = sorted(zip(
+        detections.labels,
+        (round(d * 2) / 2 for d in detections.distance.tolist()),
+        detections.direction.tolist(),
+        detections.risk.tolist(),
+    ))
+    return hashlib.sha256(json.dumps(items).encode()).hexdigest()
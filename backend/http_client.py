@@ -0,0 +1,27 @@
+import asyncio
+import httpx
+
+# Shared pooled client for all outbound Gemini calls, so requests reuse an
+# open HTTP/2 connection instead of paying a TCP+TLS handshake each time.
+# Its connections are tied to the event loop that opened them, so the client
+# is created on first use and replaced when called from a different loop or
+# after it has been closed (e.g. TestClient without `with`, or an app
+# restart in the same process).
+_client = None
+_client_loop = None
+
+def get_client():
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client.is_closed or _client_loop is not loop:
+        _client = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(10.0),
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+        )
+        _client_loop = loop
+    return _client
+
+async def close_client():
+    if _client is not None and _client_loop is asyncio.get_running_loop():
+        await _client.aclose()
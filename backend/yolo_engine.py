@@ -0,0 +1,39 @@
+"""
+Build the TensorRT engine camera_tts.py serves from on CUDA hosts.
+
+The server never exports an engine itself. Run this once per host from the
+backend directory, and again after changing the GPU, TensorRT version,
+YOLO_IMGSZ or YOLO_MAX_BATCH:
+
+    python yolo_engine.py
+"""
+import importlib.util
+import os
+import sys
+
+# Direction is only binned into thirds, so a smaller input size is plenty.
+YOLO_IMGSZ = 480
+
+# Largest batch the /detect/ micro-batcher sends in one forward pass.
+YOLO_MAX_BATCH = 8
+
+def engine_path(weights):
+    """Engine file for weights, named after the parameters it was built with."""
+    return f"{os.path.splitext(weights)[0]}-{YOLO_IMGSZ}-b{YOLO_MAX_BATCH}-fp16.engine"
+
+def export_engine(weights):
+    from ultralytics import YOLO
+
+    exported = YOLO(weights).export(
+        format="engine", half=True, imgsz=YOLO_IMGSZ,
+        dynamic=True, batch=YOLO_MAX_BATCH, workspace=4
+    )
+    os.replace(exported, engine_path(weights))
+    return engine_path(weights)
+
+if __name__ == "__main__":
+    if importlib.util.find_spec("tensorrt") is None:
+        sys.exit("tensorrt is not installed; install it before building the engine.")
+    # Fail on missing export dependencies instead of pip-installing them
+    os.environ["YOLO_AUTOINSTALL"] = "false"
+    print(f"Wrote {export_engine('yolov8n.pt')}")